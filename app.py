@@ -1,13 +1,12 @@
 import streamlit as st
 import os
+from functools import lru_cache
 import subprocess
 import tempfile
 import numpy as np
-from pydub import AudioSegment
-import noisereduce as nr
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import matplotlib.colors as mcolors
+import soundfile as sf
+import lameenc
+from denoise import DENOISE_BLOCK_S, DENOISE_OVERLAP_S, DENOISE_SAMPLE_RATE, block_bounds, denoise_blocks
 
 # 設定頁面配置
 st.set_page_config(page_title="Acoustic Noise Reduction Project", page_icon="📊", layout="wide")
@@ -30,76 +29,233 @@ st.markdown("""
 
 # --- 核心功能函數 ---
 
-def extract_audio_from_video(video_path, output_audio_path):
-    """Extract audio track from video using FFmpeg."""
+# libsndfile 可直接解碼的格式，其餘交給 FFmpeg
+SOUNDFILE_EXTENSIONS = ['.wav', '.flac', '.ogg']
+VIDEO_EXTENSIONS = ['.mov', '.mp4', '.avi', '.mkv']
+
+# MP3 編碼時每次送入的樣本數
+MP3_CHUNK_SAMPLES = 1 << 20
+
+# 頻譜圖 STFT 參數 (與原本 specgram 設定相同)
+SPEC_NFFT = 2048
+SPEC_HOP = 1024
+SPEC_WINDOW = np.hanning(SPEC_NFFT).astype(np.float32)
+
+# 快取上限：每份上傳會保留解碼、降噪、頻譜圖等大型陣列 (10 分鐘音訊約 370 MB)，
+# 只保留最近幾份，且閒置一小時後釋放
+CACHE_MAX_ENTRIES = 3
+CACHE_TTL_S = 3600
+
+
+# --- Custom Hex Color Configuration ---
+ZONES = [
+    {"range": (0, 100), "color": "#8B4513", "label": "0-100Hz: Rumble (Noise)"},
+    {"range": (100, 1000), "color": "#228B22", "label": "100-1k: Body (Fundamental)"},
+    {"range": (1000, 4000), "color": "#FFD700", "label": "1k-4k: Intelligibility"},
+    {"range": (4000, 22050), "color": "#DC143C", "label": ">4k: Air (Sibilance)"}
+]
+
+
+def downmix_to_mono(buf):
+    """Average (frames, channels) float32 samples to mono in one vectorized pass."""
+    if buf.ndim == 1:
+        return buf
+    if buf.shape[1] == 1:
+        return buf[:, 0]
+    if buf.shape[1] == 2:
+        mono = np.empty(len(buf), dtype=np.float32)
+        np.add(buf[:, 0], buf[:, 1], out=mono)
+        mono *= np.float32(0.5)
+        return mono
+    return buf.mean(axis=1, dtype=np.float32)
+
+
+def probe_channels(input_path):
+    """Channel count of the first audio stream, via ffprobe."""
     command = [
-        "ffmpeg", "-i", video_path, "-vn",
-        "-acodec", "pcm_s16le", "-ar", "44100", "-ac", "1",
-        "-y", output_audio_path
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=channels", "-of", "csv=p=0", input_path
     ]
-    try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except subprocess.CalledProcessError as e:
-        st.error(f"FFmpeg Error: {e}")
-        return False
+    proc = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    fields = proc.stdout.split()
+    if not fields:
+        raise ValueError("No audio stream found in the uploaded file.")
+    return int(fields[0])
+
+
+def decode_with_ffmpeg(input_path, sample_rate=44100):
+    """Decode any FFmpeg-readable media to mono float32 samples via a stdout pipe."""
+    # 保留原始聲道數輸出 (不加 -ac)：單聲道不被升混成立體聲，多聲道也不經 FFmpeg rematrix。
+    # -map 0:a:0 讓 FFmpeg 解碼與 ffprobe 相同的第一條音軌 (預設會選聲道數最多的那條)
+    channels = probe_channels(input_path)
+    n_threads = str(os.cpu_count() or 1)
+    command = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-threads", "0", "-filter_threads", n_threads, "-filter_complex_threads", n_threads,
+        "-i", input_path, "-map", "0:a:0", "-vn",
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ar", str(sample_rate),
+        "-"
+    ]
+    # stdout 是 PCM 資料；stderr 不使用，直接丟棄
+    proc = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
+    # FFmpeg 直接輸出原始聲道數的 float32，在 Python 端一次平均成單聲道
+    samples = np.frombuffer(proc.stdout, dtype=np.float32).reshape(-1, channels)
+    return downmix_to_mono(samples), sample_rate
+
+
+def load_audio(input_path):
+    """Read an audio file into float32 samples (libsndfile when possible, FFmpeg otherwise)."""
+    if os.path.splitext(input_path)[1].lower() not in SOUNDFILE_EXTENSIONS:
+        return decode_with_ffmpeg(input_path)
 
-def enhance_audio(input_path, output_path):
-    """Read Audio -> Apply Noise Reduction -> Export."""
     try:
-        sound = AudioSegment.from_file(input_path)
-        samples = np.array(sound.get_array_of_samples())
-
-        # 正規化數據 (float32)
-        if sound.sample_width == 2:
-            data = samples.astype(np.float32) / 32768.0
-        elif sound.sample_width == 4:
-            data = samples.astype(np.float32) / 2147483648.0
-        else:
-            data = samples.astype(np.float32)
-
-        # 應用降噪算法
-        reduced_noise_data = nr.reduce_noise(
-            y=data,
-            sr=sound.frame_rate,
-            stationary=False,
-            prop_decrease=0.95,  # 稍微提高消除比例以增強視覺對比
-            n_std_thresh_stationary=1.5,
-            time_constant_s=2.0,
-        )
-
-        # 轉回 int16
-        reduced_noise_data = (reduced_noise_data * 32768.0).astype(np.int16)
-
-        cleaned_sound = AudioSegment(
-            reduced_noise_data.tobytes(),
-            frame_rate=sound.frame_rate,
-            sample_width=2,
-            channels=1
-        )
-        cleaned_sound.export(output_path, format="mp3")
-        return True
-    except Exception as e:
-        st.error(f"Processing Error: {str(e)}")
-        return False
+        # soundfile 直接輸出已正規化的 float32
+        data, sample_rate = sf.read(input_path, dtype='float32', always_2d=False)
+    except RuntimeError:
+        # libsndfile 無法解析 (例如 WAV 內含壓縮編碼)，改交給 FFmpeg
+        return decode_with_ffmpeg(input_path)
+    return downmix_to_mono(data), sample_rate
+
+
+def enhance_audio(data, sample_rate):
+    """Apply Noise Reduction block by block -> int16 samples."""
+    n_samples = len(data)
+    overlap = DENOISE_OVERLAP_S * sample_rate
+    fade_in = np.linspace(0, 1, overlap, dtype=np.float32)
+    fade_out = fade_in[::-1]
+
+    # 每段獨立降噪，重疊區兩段權重相加為 1
+    bounds = list(block_bounds(n_samples, DENOISE_BLOCK_S * sample_rate, overlap))
+    reduced_noise_data = np.zeros(n_samples, dtype=np.float32)
+    for (start, end), block in zip(bounds, denoise_blocks(data, sample_rate, bounds)):
+        if start > 0:
+            block[:overlap] *= fade_in
+        if end < n_samples:
+            block[-overlap:] *= fade_out
+        reduced_noise_data[start:end] += block
+
+    # 轉回 int16 (就地縮放與截斷，避免額外的暫存陣列)
+    np.multiply(reduced_noise_data, 32768.0, out=reduced_noise_data)
+    np.clip(reduced_noise_data, -32768, 32767, out=reduced_noise_data)
+    return reduced_noise_data.astype(np.int16)
+
+
+def encode_mp3(samples, sample_rate):
+    """Encode int16 mono samples to MP3 bytes (shared by the player and the download button)."""
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(128)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(1)
+    encoder.set_quality(2)  # 2 = 高品質, 7 = 最快
+
+    # 分段送入編碼器，避免一次複製整段 PCM
+    mp3_data = bytearray()
+    for start in range(0, len(samples), MP3_CHUNK_SAMPLES):
+        mp3_data += encoder.encode(samples[start:start + MP3_CHUNK_SAMPLES].tobytes())
+    mp3_data += encoder.flush()
+    return bytes(mp3_data)
+
+
+def compute_spectrogram(samples, sample_rate):
+    """
+    Batched STFT power spectrum in dB, scaled like matplotlib's specgram (PSD, one-sided).
+    Returns (Pxx_db[frames, bins], frame center times).
+    """
+    if len(samples) < SPEC_NFFT:
+        samples = np.pad(samples, (0, SPEC_NFFT - len(samples)))
+
+    # Peak normalization is folded into the window: no scaled copy of the signal
+    peak = max(-float(samples.min()), float(samples.max()))
+    window = SPEC_WINDOW / peak if peak > 0 else SPEC_WINDOW
+
+    # Zero-copy frame matrix, then one multi-threaded rfft over all frames
+    frames = np.lib.stride_tricks.sliding_window_view(samples, SPEC_NFFT)[::SPEC_HOP]
+    # scipy.fft 延後到第一次繪圖時才 import (首頁不需要)；pocketfft 多執行緒批次 rfft
+    from scipy import fft as sp_fft
+
+    spectrum = sp_fft.rfft(frames * window, axis=1, workers=-1)
+    times = (np.arange(len(frames)) * SPEC_HOP + SPEC_NFFT / 2) / sample_rate
+
+    # float32 throughout (complex64 spectrum -> float32 dB), computed in place
+    psd = np.abs(spectrum)
+    np.square(psd, out=psd)
+    psd *= np.float32(1.0 / (sample_rate * np.sum(SPEC_WINDOW ** 2, dtype=np.float64)))
+    psd[:, 1:-1] *= 2
+    psd += np.float32(1e-20)
+    np.log10(psd, out=psd)
+    psd *= 10
+    return psd, times
+
+
+# --- 快取層：以上傳檔案的完整 bytes 為 key ---
+# st.cache_data 對 bytes 做完整雜湊；大型 ndarray 只抽樣雜湊，不適合當 key。
+# 例外不會被快取，失敗後重新操作即可重試。
+# 每次命中都會 unpickle 整份結果，所以取樣率與 MP3 另外快取，主流程不必載入整段陣列。
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+def decode_upload(raw_bytes, file_name):
+    """Decode an uploaded file to (mono float32 samples, sample_rate)."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_path = os.path.join(temp_dir, file_name)
+        with open(input_path, "wb") as f:
+            f.write(raw_bytes)
+
+        if os.path.splitext(file_name)[1].lower() in VIDEO_EXTENSIONS:
+            return decode_with_ffmpeg(input_path)
+        return load_audio(input_path)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+def upload_sample_rate(raw_bytes, file_name):
+    """Sample rate of the decoded upload."""
+    return decode_upload(raw_bytes, file_name)[1]
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+def denoise_upload(raw_bytes, file_name):
+    """Denoise an uploaded file -> int16 samples."""
+    data, sample_rate = decode_upload(raw_bytes, file_name)
+    return enhance_audio(data, sample_rate)
+
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+def upload_mp3(raw_bytes, file_name):
+    """MP3 bytes of the denoised upload (shared by the player and the download button)."""
+    return encode_mp3(denoise_upload(raw_bytes, file_name), upload_sample_rate(raw_bytes, file_name))
 
-def plot_enhanced_spectrogram(file_path, title):
+
+@st.cache_data(show_spinner=False, max_entries=2 * CACHE_MAX_ENTRIES, ttl=CACHE_TTL_S)
+def upload_spectrogram(raw_bytes, file_name, cleaned):
+    """Spectrogram (Pxx_db, times) of the original or the denoised upload."""
+    if cleaned:
+        data = denoise_upload(raw_bytes, file_name)
+    else:
+        data, _ = decode_upload(raw_bytes, file_name)
+    return compute_spectrogram(data, upload_sample_rate(raw_bytes, file_name))
+
+
+@lru_cache(maxsize=1)
+def high_contrast_cmap():
+    """
+    Custom High-Contrast Colormap (built once, on first plot).
+    This creates a colormap that transitions from pure White to pure Black.
+    Loud sounds will now be drawn in solid black, making them pop out.
+    """
+    import matplotlib.colors as mcolors
+
+    # N=64 is visually identical to 256 for a 2-color ramp and keeps the LUT small
+    return mcolors.LinearSegmentedColormap.from_list('high_contrast_wb', [(1, 1, 1), (0, 0, 0)], N=64)
+
+
+def plot_enhanced_spectrogram(Pxx, times, sample_rate, title):
     """
     Plot spectrogram with Custom Hex Colors and HIGH-CONTRAST Black lines.
+    `Pxx` and `times` come from compute_spectrogram.
     """
-    # Load data
-    sound = AudioSegment.from_file(file_path)
-    samples = np.array(sound.get_array_of_samples())
-    if sound.channels == 2:
-        samples = samples.reshape((-1, 2))[:, 0]
-
-    # Normalize
-    samples = samples.astype(np.float32)
-    max_val = np.max(np.abs(samples))
-    if max_val > 0:
-        samples = samples / max_val
+    # Matplotlib 只在真正繪圖時載入，首頁 (尚未上傳檔案) 不需付出 import 成本
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
 
     # Create Plot
     fig, ax = plt.subplots(figsize=(10, 5))
@@ -108,38 +264,25 @@ def plot_enhanced_spectrogram(file_path, title):
     fig.patch.set_facecolor('#ffffff')
     ax.set_facecolor('#ffffff')
 
-    # --- CHANGE: Create a custom High-Contrast Colormap ---
-    # This creates a colormap that transitions from pure White to pure Black.
-    # Loud sounds will now be drawn in solid black, making them pop out.
-    colors = [(1, 1, 1), (0, 0, 0)]  # White -> Black
-    cmap_name = 'high_contrast_wb'
-    # N=256 gives a smooth transition, you can lower it for an even starker look
-    cm = mcolors.LinearSegmentedColormap.from_list(cmap_name, colors, N=256)
-
-    # Draw Spectrogram using the new custom colormap
-    Pxx, freqs, bins, im = ax.specgram(
-        samples,
-        Fs=sound.frame_rate,
-        NFFT=2048,
-        noverlap=1024,
-        cmap=cm,  # <--- Use the custom high-contrast map
-        scale='dB',
+    # Draw Spectrogram using the custom high-contrast colormap
+    half_hop = SPEC_HOP / sample_rate / 2
+    t_start, t_end = times[0] - half_hop, times[-1] + half_hop
+    im = ax.imshow(
+        Pxx.T,
+        origin='lower',
+        aspect='auto',
+        extent=[t_start, t_end, 0, sample_rate / 2],
+        cmap=high_contrast_cmap(),
         vmin=-80,
-        vmax=0
+        vmax=0,
+        interpolation='nearest',
+        rasterized=True
     )
 
-    # --- Custom Hex Color Configuration (Same as before) ---
-    zones = [
-        {"range": (0, 100), "color": "#8B4513", "label": "0-100Hz: Rumble (Noise)"},
-        {"range": (100, 1000), "color": "#228B22", "label": "100-1k: Body (Fundamental)"},
-        {"range": (1000, 4000), "color": "#FFD700", "label": "1k-4k: Intelligibility"},
-        {"range": (4000, 22050), "color": "#DC143C", "label": ">4k: Air (Sibilance)"}
-    ]
-
-    # Draw colored overlays
-    for zone in zones:
+    # Draw colored overlays as plain rectangles over the image
+    for zone in ZONES:
         # alpha=0.25 is good, but you can lower it to 0.2 if the lines are still obscure
-        ax.axhspan(zone["range"][0], zone["range"][1], color=zone["color"], alpha=0.25)
+        ax.fill_betweenx(zone["range"], t_start, t_end, color=zone["color"], alpha=0.25, linewidth=0, zorder=2)
 
     # Text Styling
     ax.set_title(title, color='black', fontsize=14, pad=20)
@@ -147,10 +290,11 @@ def plot_enhanced_spectrogram(file_path, title):
     ax.set_xlabel('Time (s)', color='black')
     ax.tick_params(axis='x', colors='black')
     ax.tick_params(axis='y', colors='black')
+    ax.set_xlim(t_start, t_end)
     ax.set_ylim(0, 10000)
 
     # Custom Legend
-    legend_patches = [mpatches.Patch(color=z["color"], label=z["label"], alpha=0.5) for z in zones]
+    legend_patches = [mpatches.Patch(color=z["color"], label=z["label"], alpha=0.5) for z in ZONES]
     ax.legend(handles=legend_patches, loc='upper center', bbox_to_anchor=(0.5, -0.15),
               fancybox=True, shadow=True, ncol=2, facecolor='#f0f0f0', labelcolor='black')
 
@@ -176,74 +320,72 @@ This tool visualizes the effect of **AI Noise Reduction** on the audio spectrum.
 uploaded_file = st.file_uploader("📂 Upload File (Support .mp4, .mov, .wav, .mp3)", type=["mov", "mp4", "mp3", "wav"])
 
 if uploaded_file is not None:
-    with tempfile.TemporaryDirectory() as temp_dir:
-        input_path = os.path.join(temp_dir, uploaded_file.name)
-        extracted_audio_path = os.path.join(temp_dir, "extracted_raw.wav")
-        final_output_path = os.path.join(temp_dir, "cleaned_output.mp3")
-
-        with open(input_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+    # 上傳內容只讀取一次，播放器與解碼共用；快取以這份 bytes 為 key
+    raw_bytes = uploaded_file.getvalue()
+    file_name = uploaded_file.name
 
-        # Determine process flow
-        file_extension = os.path.splitext(input_path)[1].lower()
-        is_video = file_extension in ['.mov', '.mp4', '.avi', '.mkv']
+    # Determine process flow
+    file_extension = os.path.splitext(file_name)[1].lower()
+    is_video = file_extension in VIDEO_EXTENSIONS
 
-        status_box = st.status("🚀 System Processing...", expanded=True)
+    status_box = st.status("🚀 System Processing...", expanded=True)
 
+    try:
         # 1. Extraction / Loading
         if is_video:
             status_box.write("Extracting audio from video...")
-            success = extract_audio_from_video(input_path, extracted_audio_path)
-            processing_source = extracted_audio_path
         else:
             status_box.write("Loading audio file...")
-            processing_source = input_path
-            success = True
-
-        if success:
-            # 2. Denoising
-            status_box.write("Applying AI Noise Reduction...")
-            enhancement_success = enhance_audio(processing_source, final_output_path)
-
-            if enhancement_success:
-                status_box.update(label="✅ Processing Complete!", state="complete", expanded=False)
-
-                # --- Results Display ---
-                col1, col2 = st.columns(2)
-
-                # Left: Original
-                with col1:
-                    st.subheader("🎧 Original Audio (Raw)")
-                    if is_video:
-                        with open(input_path, "rb") as f:
-                            st.video(f.read())
-                    else:
-                        st.audio(processing_source)
-
-                    st.markdown("**Original Spectrogram**")
-                    with st.spinner("Rendering Original Plot..."):
-                        fig_orig = plot_enhanced_spectrogram(processing_source, "Original Audio Spectrogram")
-                        st.pyplot(fig_orig)
-
-                # Right: Processed
-                with col2:
-                    st.subheader("🎹 Denoised Audio")
-                    with open(final_output_path, "rb") as f:
-                        processed_bytes = f.read()
-                    st.audio(processed_bytes, format='audio/mp3')
-
-                    st.markdown("**Denoised Spectrogram**")
-                    st.info("💡 Note: Observe if the **Brown Zone (Rumble)** turns black. This indicates noise removal.")
-                    with st.spinner("Rendering Denoised Plot..."):
-                        fig_clean = plot_enhanced_spectrogram(final_output_path, "Cleaned Audio Spectrogram")
-                        st.pyplot(fig_clean)
-
-                    st.download_button(
-                        label="📥 Download Cleaned MP3",
-                        data=processed_bytes,
-                        file_name="enhanced_audio.mp3",
-                        mime="audio/mp3"
-                    )
+        sample_rate = upload_sample_rate(raw_bytes, file_name)
+
+        # 2. Denoising
+        status_box.write("Applying AI Noise Reduction...")
+        processed_bytes = upload_mp3(raw_bytes, file_name)
+    except subprocess.CalledProcessError as e:
+        st.error(f"FFmpeg Error: {e}")
+    except Exception as e:
+        st.error(f"Processing Error: {str(e)}")
+    else:
+        status_box.update(label="✅ Processing Complete!", state="complete", expanded=False)
+
+        # --- Results Display ---
+        col1, col2 = st.columns(2)
+
+        # Left: Original
+        with col1:
+            st.subheader("🎧 Original Audio (Raw)")
+            if is_video:
+                st.video(raw_bytes)
+            else:
+                st.audio(raw_bytes, format=uploaded_file.type)
+
+            st.markdown("**Original Spectrogram**")
+            with st.spinner("Rendering Original Plot..."):
+                Pxx, times = upload_spectrogram(raw_bytes, file_name, cleaned=False)
+                fig_orig = plot_enhanced_spectrogram(Pxx, times, sample_rate, "Original Audio Spectrogram")
+                st.pyplot(fig_orig)
+
+        # Right: Processed
+        with col2:
+            st.subheader("🎹 Denoised Audio")
+            st.audio(processed_bytes, format='audio/mp3')
+
+            st.markdown("**Denoised Spectrogram**")
+            st.info("💡 Note: Observe if the **Brown Zone (Rumble)** turns black. This indicates noise removal.")
+            # 只有取樣率高於 DENOISE_SAMPLE_RATE 時才有高頻段被原樣保留
+            if sample_rate > DENOISE_SAMPLE_RATE:
+                st.caption(f"Noise reduction runs below {DENOISE_SAMPLE_RATE // 2000} kHz; content above that is passed through unchanged.")
+            with st.spinner("Rendering Denoised Plot..."):
+                Pxx, times = upload_spectrogram(raw_bytes, file_name, cleaned=True)
+                fig_clean = plot_enhanced_spectrogram(Pxx, times, sample_rate, "Cleaned Audio Spectrogram")
+                st.pyplot(fig_clean)
+
+            st.download_button(
+                label="📥 Download Cleaned MP3",
+                data=processed_bytes,
+                file_name="enhanced_audio.mp3",
+                mime="audio/mp3"
+            )
 
 st.markdown("---")
 st.caption("Powered by Streamlit, FFmpeg & Noisereduce")
\ No newline at end of file
@@ -0,0 +1,156 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import repeat
+from multiprocessing import shared_memory
+import numpy as np
+
+# 降噪相關函數獨立成模組，讓 ProcessPoolExecutor 的子行程可以 import
+# (Streamlit 以 __main__ 執行 app.py，子行程無法從那裡取得函數)
+
+# 降噪時使用的取樣率 (語音能量集中在 8 kHz 以下)
+DENOISE_SAMPLE_RATE = 16000
+
+# 分段降噪：每段長度與重疊 (秒)，重疊區以線性交叉淡化拼接
+DENOISE_BLOCK_S = 30
+DENOISE_OVERLAP_S = 2
+
+# 區段數少於此值時在本行程內逐段處理：單段約 0.2 s，少量區段抵不上行程池的 IPC 與首次啟動成本
+POOL_MIN_BLOCKS = 4
+
+
+@lru_cache(maxsize=1)
+def cuda_available():
+    """True when the optional torch backend is installed and sees a CUDA device."""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+@lru_cache(maxsize=1)
+def process_pool():
+    """
+    Long-lived worker pool shared by all sessions, started on first use.
+    Each spawned worker re-imports app.py, scipy and numba once (~1-2 s), so the pool is kept
+    rather than rebuilt per upload.
+    """
+    # spawn 而非 fork：Streamlit 伺服器是多執行緒的，fork 後子行程可能繼承被鎖住的 lock。
+    # 子行程會以 bare mode 重新 import app.py (__mp_main__)，此時 file_uploader 回傳 None，不會執行任何處理
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+
+def block_bounds(n_samples, block_len, overlap):
+    """Yield (start, end) of overlapping blocks covering n_samples."""
+    step = block_len - overlap
+    for start in range(0, max(n_samples - overlap, 1), step):
+        yield start, min(start + block_len, n_samples)
+
+
+def denoise_block(y, sample_rate, use_gpu=False, use_fast=False):
+    """
+    Denoise one block at DENOISE_SAMPLE_RATE and return it at the original rate.
+    `use_fast` selects nr_fast; the caller decides it once via nr_fast.available().
+    """
+    # scipy.signal 載入約 0.5 s (比 matplotlib 還重)，延後到第一次降噪時才 import
+    from scipy import signal as sp_signal
+
+    # 降頻至 16 kHz 以減少 STFT 運算量
+    denoise_rate = min(sample_rate, DENOISE_SAMPLE_RATE)
+    if denoise_rate != sample_rate:
+        y_down = sp_signal.resample_poly(y, denoise_rate, sample_rate)
+    else:
+        y_down = y
+
+    # 應用降噪算法 (CPU 單聲道走 Numba 版本，其餘交給 noisereduce)
+    # noisereduce 與 numba 載入很慢，延後到第一次降噪時才 import
+    import nr_fast
+
+    if use_fast and not use_gpu and nr_fast.supports(y_down):
+        reduced = nr_fast.reduce_noise_nonstationary(
+            np.asarray(y_down, dtype=np.float32),
+            denoise_rate,
+            prop_decrease=0.95,
+            time_constant_s=2.0,
+        )
+    else:
+        import noisereduce as nr
+
+        reduced = nr.reduce_noise(
+            y=y_down,
+            sr=denoise_rate,
+            stationary=False,
+            prop_decrease=0.95,  # 稍微提高消除比例以增強視覺對比
+            n_std_thresh_stationary=1.5,
+            time_constant_s=2.0,
+            use_torch=use_gpu,  # torch 版本在 GPU 上執行 STFT 與遮罩平滑
+            device="cuda" if use_gpu else "cpu",
+        )
+
+    # 全靜音的頻帶在遮罩計算中是 0/0 = NaN；換成 0，靜音段輸出靜音，
+    # 也不會在交叉淡化時把相鄰區段的重疊區一起變成 NaN
+    reduced = np.nan_to_num(reduced, copy=False)
+
+    # 升頻回原始取樣率，長度對齊輸入
+    if denoise_rate != sample_rate:
+        reduced = sp_signal.resample_poly(reduced, sample_rate, denoise_rate)[:len(y)]
+
+        # 16 kHz 來回會濾掉 denoise_rate/2 以上的頻段；把原始的高頻殘差 (未降噪) 加回，
+        # 否則頻譜圖上 8 kHz 以上會被誤認為「已降噪」
+        low_band = sp_signal.resample_poly(y_down, sample_rate, denoise_rate)[:len(y)]
+        reduced += y
+        reduced -= low_band
+    return reduced
+
+
+def denoise_shared_block(shm_name, start, end, sample_rate, use_fast):
+    """Worker entry point: denoise samples [start, end) of a float32 shared-memory buffer."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # 只複製本段資料，釋放 view 後才能 close
+        block = np.array(np.ndarray((end - start,), dtype=np.float32, buffer=shm.buf,
+                                    offset=start * np.dtype(np.float32).itemsize))
+    finally:
+        shm.close()
+    return denoise_block(block, sample_rate, use_fast=use_fast)
+
+
+def denoise_blocks(data, sample_rate, bounds):
+    """Yield denoised blocks for `bounds` in order, on the GPU if available, else across CPU cores."""
+    # GPU 一次處理一段即可滿載，且 CUDA 不能在 fork 出的子行程中使用
+    if cuda_available():
+        for start, end in bounds:
+            yield denoise_block(data[start:end], sample_rate, use_gpu=True)
+        return
+
+    # nr_fast 的自我比對只在主行程做一次 (lru_cache)，結果傳給子行程，
+    # 避免每個 spawn 出來的子行程都重新 import noisereduce 並比對
+    import nr_fast
+
+    use_fast = nr_fast.available()
+
+    # 單核心或區段不多時，行程池只有額外開銷
+    if (os.cpu_count() or 1) < 2 or len(bounds) < POOL_MIN_BLOCKS:
+        for start, end in bounds:
+            yield denoise_block(data[start:end], sample_rate, use_fast=use_fast)
+        return
+
+    # 原始訊號放進共享記憶體，子行程依名稱取用，不經 pickle 傳送整段陣列
+    data = np.asarray(data, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=np.float32, buffer=shm.buf)[:] = data
+        starts, ends = zip(*bounds)
+        try:
+            yield from process_pool().map(denoise_shared_block, repeat(shm.name), starts, ends,
+                                          repeat(sample_rate), repeat(use_fast))
+        except BrokenProcessPool:
+            # 子行程異常結束後整個池無法再用；下次上傳重新建立
+            process_pool.cache_clear()
+            raise
+    finally:
+        shm.close()
+        shm.unlink()
\ No newline at end of file
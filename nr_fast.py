@@ -0,0 +1,127 @@
+from functools import lru_cache
+import numpy as np
+from scipy.signal import fftconvolve, stft, istft
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# noisereduce.reduce_noise(stationary=False) 的單聲道版本，遮罩計算以 Numba 編譯
+# 參數預設值與 noisereduce 3.x 相同，輸出與原版數值一致 (float32 誤差內)
+# numba 列在 requirements.txt；若環境缺少 numba、或與 noisereduce 的自我比對不一致，
+# available() 回傳 False，denoise.py 會改用 nr.reduce_noise
+
+N_FFT = 1024
+HOP_LENGTH = N_FFT // 4
+CHUNK_SIZE = 600000  # 超過此長度時 noisereduce 會再切段，此處不支援
+PADDING = 30000
+FREQ_MASK_SMOOTH_HZ = 500
+TIME_MASK_SMOOTH_MS = 50
+THRESH_N_MULT_NONSTATIONARY = 2
+SIGMOID_SLOPE_NONSTATIONARY = 10
+
+
+def smoothed_sigmoid_mask(abs_stft, b, shift, slope):
+    """
+    Per frequency bin: zero-phase one-pole smoothing over time (filtfilt with
+    padtype=None), then a sigmoid of how far each frame sits above that mean.
+    """
+    n_freq, n_time = abs_stft.shape
+    mask = np.empty_like(abs_stft)
+    for f in range(n_freq):
+        row = abs_stft[f]
+        smooth = np.empty(n_time, dtype=abs_stft.dtype)
+
+        # Forward pass, initial state = steady state for row[0]
+        acc = row[0]
+        for t in range(n_time):
+            acc = b * row[t] + (1.0 - b) * acc
+            smooth[t] = acc
+
+        # Backward pass, initial state = steady state for the last forward output
+        acc = smooth[n_time - 1]
+        for t in range(n_time - 1, -1, -1):
+            acc = b * smooth[t] + (1.0 - b) * acc
+            smooth[t] = acc
+
+        for t in range(n_time):
+            above = (row[t] - smooth[t]) / smooth[t]
+            mask[f, t] = 1.0 / (1.0 + np.exp(-(above + shift) * slope))
+    return mask
+
+
+# 不使用 parallel=True：Streamlit 每個 session 一條執行緒，Numba 的 threading layer
+# (workqueue / omp) 不支援並行呼叫或之後的 fork；跨核心已由 denoise.py 的行程池負責
+# error_model='numpy'：全靜音的頻帶 smooth 為 0，0/0 得到 NaN (與 noisereduce 相同)，
+# 而不是 Python 預設模型的 ZeroDivisionError
+if njit is not None:
+    smoothed_sigmoid_mask = njit(fastmath=True, cache=True, error_model='numpy')(smoothed_sigmoid_mask)
+
+
+def smoothing_filter(sr):
+    """2-D triangular kernel used to smooth the mask across frequency and time."""
+    n_grad_freq = int(FREQ_MASK_SMOOTH_HZ / (sr / (N_FFT / 2)))
+    n_grad_time = int(TIME_MASK_SMOOTH_MS / ((HOP_LENGTH / sr) * 1000))
+    kernel = np.outer(
+        np.concatenate([np.linspace(0, 1, n_grad_freq + 1, endpoint=False), np.linspace(1, 0, n_grad_freq + 2)])[1:-1],
+        np.concatenate([np.linspace(0, 1, n_grad_time + 1, endpoint=False), np.linspace(1, 0, n_grad_time + 2)])[1:-1],
+    )
+    return kernel / np.sum(kernel)
+
+
+@lru_cache(maxsize=1)
+def matches_noisereduce():
+    """
+    One-time self-check against nr.reduce_noise on fixed synthetic clips
+    (a gated tone in noise, and digital silence).
+    Catches drift if noisereduce changes its internals or defaults.
+    """
+    import noisereduce as nr
+
+    sr = 16000
+    t = np.arange(2 * sr) / sr
+    noise = np.random.default_rng(0).standard_normal(len(t))
+    tone = (0.3 * np.sin(2 * np.pi * 440 * t) * (t % 1 < 0.5) + 0.05 * noise).astype(np.float32)
+    silence = np.zeros(len(t), dtype=np.float32)
+
+    for y in (tone, silence):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = nr.reduce_noise(y=y, sr=sr, stationary=False, prop_decrease=0.95, time_constant_s=2.0)
+        try:
+            actual = reduce_noise_nonstationary(y, sr, prop_decrease=0.95, time_constant_s=2.0)
+        except ArithmeticError:
+            return False
+        if actual.shape != expected.shape or not np.allclose(actual, expected, atol=1e-5, equal_nan=True):
+            return False
+    return True
+
+
+def available():
+    """True when numba is installed and the self-check passed (cached per process)."""
+    return njit is not None and matches_noisereduce()
+
+
+def supports(y):
+    """True when `y` fits the fast path (mono, a single noisereduce chunk)."""
+    return y.ndim == 1 and len(y) <= CHUNK_SIZE
+
+
+def reduce_noise_nonstationary(y, sr, prop_decrease=1.0, time_constant_s=2.0):
+    """Drop-in for nr.reduce_noise(y=y, sr=sr, stationary=False, ...) on a 1-D signal."""
+    # Zero padding on both sides, as noisereduce does for each chunk
+    padded = np.zeros(len(y) + 2 * PADDING, dtype=y.dtype)
+    padded[PADDING:PADDING + len(y)] = y
+
+    _, _, sig_stft = stft(padded, nfft=N_FFT, noverlap=N_FFT - HOP_LENGTH, nperseg=N_FFT, padded=False)
+
+    t_frames = time_constant_s * sr / float(HOP_LENGTH)
+    b = (np.sqrt(1 + 4 * t_frames ** 2) - 1) / (2 * t_frames ** 2)
+    sig_mask = smoothed_sigmoid_mask(np.abs(sig_stft), b, -THRESH_N_MULT_NONSTATIONARY, SIGMOID_SLOPE_NONSTATIONARY)
+
+    sig_mask = fftconvolve(sig_mask, smoothing_filter(sr), mode="same")
+    sig_mask = sig_mask * prop_decrease + (1.0 - prop_decrease)
+
+    _, denoised = istft(sig_stft * sig_mask, nfft=N_FFT, noverlap=N_FFT - HOP_LENGTH, nperseg=N_FFT)
+    out = np.zeros(len(padded), dtype=y.dtype)
+    out[:len(denoised)] = denoised
+    return out[PADDING:PADDING + len(y)]
\ No newline at end of file